@@ -1,5 +1,6 @@
 import inspect
 import logging
+import pickle
 import secrets
 import threading
 import time
@@ -7,8 +8,15 @@ import typing
 
 import pika.exchange_type
 
+from . import metrics as _metrics
+from . import recording as _recording
 from .basic_consumer import BasicConsumer as _BasicConsumer
 from .exceptions import MaxConnectionAttemptsReached as _MaxConnectionAttemptsReached
+from .introspection import IntrospectionServer as _IntrospectionServer
+from .payload_transport import DEFAULT_SHARED_MEMORY_THRESHOLD as _DEFAULT_SHARED_MEMORY_THRESHOLD
+from .payload_transport import SharedMemoryTransport as _SharedMemoryTransport
+from .sharding import ShardingConfiguration
+from .validation import ValidationPipeline
 
 _logger = logging.getLogger(__name__)
 
@@ -20,10 +28,18 @@ class Server:
             amqp_dsn: str,
             exchange_name: str,
             executor: typing.Callable[[bytes], bytes],
-            content_validator: typing.Optional[typing.Callable[[bytes], bool]] = None,
+            content_validator: typing.Optional[
+                typing.Union[typing.Callable[[bytes], bool], ValidationPipeline]
+            ] = None,
             queue_name: typing.Optional[str] = None,
             exchange_type: pika.exchange_type.ExchangeType = pika.exchange_type.ExchangeType.fanout,
-            max_reconnection_attempts: int = 5
+            max_reconnection_attempts: int = 5,
+            worker_processes: int = 0,
+            shared_memory_threshold: int = _DEFAULT_SHARED_MEMORY_THRESHOLD,
+            introspection_port: typing.Optional[int] = None,
+            introspection_host: str = '127.0.0.1',
+            record_file: typing.Optional[str] = None,
+            sharding: typing.Optional[ShardingConfiguration] = None
     ):
         """
         Initialize a new RPC server with an underlying :class:`~.basic_consumer.BasicConsumer`
@@ -37,11 +53,13 @@ class Server:
             :class:`~.basic_consumer.BasicConsumer` will create the exchange
         :type exchange_name: str
         :param executor: A method which handles the incoming message bytes and provides a
-            response as bytes
+            response as bytes. If the content_validator is a
+            :class:`~.validation.ValidationPipeline` with a decoder, the executor will receive
+            the decoded content instead of the message bytes
         :type executor: Callable[[bytes], bytes]
-        :param content_validator: A method which will validate the message content before it is
-            passed to the executor
-        :type content_validator: Callable[[bytes], bytes], optional
+        :param content_validator: A method or a :class:`~.validation.ValidationPipeline` which
+            will validate the message content before it is passed to the executor
+        :type content_validator: Callable[[bytes], bool] | ValidationPipeline, optional
         :param queue_name: The name of the queue which will be bound to the specified exchange,
             defaults to :func:`secrets.token_urlsafe`
         :type queue_name: str, optional
@@ -50,6 +68,35 @@ class Server:
             to match the one the exchange on the message broker has, defaults to
             :py:enum:`pika.exchange_type.ExchangeType.fanout`
         :type exchange_type: pika.exchange_type.ExchangeType
+        :param max_reconnection_attempts: The maximum number of reconnection attempts before
+            the server gives up, defaults to 5
+        :type max_reconnection_attempts: int, optional
+        :param worker_processes: The number of worker processes the executor will be run in. If
+            set to zero, the executor is run in the thread of the consumer. If worker processes
+            are used, the executor needs to be defined on the module level, defaults to 0
+        :type worker_processes: int, optional
+        :param shared_memory_threshold: The size in bytes from which on message bodies and
+            results are exchanged with the worker processes via shared memory instead of being
+            pickled, defaults to 64 KiB
+        :type shared_memory_threshold: int, optional
+        :param introspection_port: The port of an HTTP endpoint reporting the health
+            (``/health``), readiness (``/ready``) and status (``/status``) of the server. If no
+            port is supplied, the endpoint will not be started. If the port is ``0`` a free port
+            will be chosen
+        :type introspection_port: int, optional
+        :param introspection_host: The host the introspection endpoint is bound to, defaults to
+            ``127.0.0.1``
+        :type introspection_host: str, optional
+        :param record_file: The path of a file into which every received delivery will be
+            recorded. The file is overwritten when the server is started. The record file may be
+            replayed later using :meth:`replay`
+        :type record_file: str, optional
+        :param sharding: The configuration for a sharded consumption. If a configuration is
+            supplied, the exchange is declared as consistent hash exchange, the queue is split
+            into shard queues and the server only consumes the shards assigned to its replica.
+            The exchange_type is ignored and a queue_name is required, since all replicas need
+            to use the same shard queues
+        :type sharding: ~.sharding.ShardingConfiguration, optional
         """
         # = Validate AMQP Data Source Name =
         if amqp_dsn is None:
@@ -75,16 +122,19 @@ class Server:
         executor_signature = inspect.signature(executor)
         # Check the signature for an input as bytes
         executor_parameters = list(executor_signature.parameters.values())
-        # Get the first parameter and check if the annotation is either empty or bytes
+        # Get the first parameter and check if the annotation is either empty or bytes. If the
+        # message is decoded by a validation pipeline the executor may accept any type
         input_param = executor_parameters[0]
-        if input_param.annotation not in [inspect.Signature.empty, bytes]:
+        decodes_content = isinstance(content_validator, ValidationPipeline) \
+            and content_validator.decoder is not None
+        if not decodes_content and input_param.annotation not in [inspect.Signature.empty, bytes]:
             raise TypeError('Expected the executor to accept bytes as input parameter')
         # Now check the return type
         if executor_signature.return_annotation not in [inspect.Signature.empty, bytes]:
             raise TypeError('Expected the executor to return bytes')
         # = End of executor validation =
         # = Check the content_validator if it is set =
-        if content_validator is not None:
+        if content_validator is not None and not isinstance(content_validator, ValidationPipeline):
             # Check if the validator is a method
             if not inspect.isfunction(content_validator):
                 raise TypeError('The content_validator needs to be a method')
@@ -106,9 +156,28 @@ class Server:
         if queue_name is not None:
             if len(queue_name.strip()) == 0:
                 raise ValueError('When supplying a queue_name it may not be empty')
+        elif sharding is not None:
+            raise ValueError('The queue_name is required when using a sharded consumption')
         else:
             queue_name = secrets.token_urlsafe(nbytes=32)
         # = Finished queue_name check =
+        # = Check the worker processes =
+        if worker_processes < 0:
+            raise ValueError('The number of worker_processes may not be negative')
+        if shared_memory_threshold < 0:
+            raise ValueError('The shared_memory_threshold may not be negative')
+        if worker_processes > 0:
+            # The executor is sent to the worker processes, which requires it to be picklable
+            try:
+                pickle.dumps(executor)
+            except Exception as error:
+                raise TypeError('The executor needs to be picklable to run in worker processes. '
+                                'Define the executor on the module level') from error
+        # = Finished the worker processes check =
+        # = Check the introspection port =
+        if introspection_port is not None and not 0 <= introspection_port <= 65535:
+            raise ValueError('The introspection_port needs to be between 0 and 65535')
+        # = Finished the introspection port check =
         self._amqp_dsn = amqp_dsn
         self._exchange_name = exchange_name
         self._executor = executor
@@ -116,15 +185,43 @@ class Server:
         self._queue_name = queue_name
         self._exchange_type = exchange_type
         self._max_reconnection_attempts = max_reconnection_attempts
+        self._sharding = sharding
+        self._worker_processes = worker_processes
+        self._shared_memory_threshold = shared_memory_threshold
         self._current_reconnection_attempts = 0
+        # Create the pool of worker processes if the executor shall not run in the consumer
+        self._payload_transport: typing.Optional[_SharedMemoryTransport] = None
+        if worker_processes > 0:
+            self._payload_transport = _SharedMemoryTransport(
+                worker_processes, shared_memory_threshold
+            )
+        # Create the statistics which are shared by all consumers of this server
+        self._statistics = _metrics.ServerStatistics()
+        # Create the recorder if the deliveries shall be recorded
+        self._recorder: typing.Optional[_recording.DeliveryRecorder] = None
+        if record_file is not None:
+            self._recorder = _recording.DeliveryRecorder(record_file)
         # Create the underlying BasicConsumer
         self._consumer = _BasicConsumer(
-            amqp_dsn, exchange_name, executor, content_validator, queue_name, exchange_type
+            amqp_dsn, exchange_name, executor, content_validator, queue_name, exchange_type,
+            self._payload_transport, self._statistics, self._recorder, sharding
         )
         self._consumer_tread: typing.Optional[threading.Thread] = None
         self._stop_event = threading.Event()
         self._error_risen = threading.Event()
         self._error: typing.Optional[Exception] = None
+        self._introspection_server: typing.Optional[_IntrospectionServer] = None
+        if introspection_port is not None:
+            self._introspection_server = _IntrospectionServer(
+                self.status, introspection_host, introspection_port
+            )
+    
+    @property
+    def introspection_port(self) -> typing.Optional[int]:
+        """The port the introspection endpoint is bound to, if the endpoint is enabled"""
+        if self._introspection_server is None:
+            return None
+        return self._introspection_server.port
     
     def start_server(self):
         """Start the AMQP RPC Server and the underlying basic consumer in another thread"""
@@ -132,25 +229,140 @@ class Server:
             target=self._start_with_reconnecting_loop,
             daemon=True
         )
+        if self._recorder is not None:
+            self._recorder.open()
         self._consumer_tread.start()
+        if self._introspection_server is not None:
+            self._introspection_server.start()
+    
+    def status(self) -> typing.Dict[str, typing.Any]:
+        """
+        Get the current status of the server
+
+        The server is healthy as long as it is running and did not give up reconnecting to the
+        message broker. The server is ready while it is consuming messages.
+
+        :return: The health, readiness, connection state and message statistics of the server
+        :rtype: dict
+        """
+        status = self._statistics.snapshot()
+        status['healthy'] = self._consumer_tread is not None and self._consumer_tread.is_alive() \
+            and self._error is None
+        status['ready'] = status['healthy'] and self._consumer.is_consuming
+        status['consuming'] = self._consumer.is_consuming
+        status['max_reconnection_attempts'] = self._max_reconnection_attempts
+        if isinstance(self._content_validator, ValidationPipeline):
+            status['validation'] = self._content_validator.statistics
+        if self._sharding is not None:
+            status['sharding'] = {
+                'replica_id':      self._sharding.replica_id,
+                'replicas':        sorted(self._sharding.replicas),
+                'assigned_shards': self._sharding.assigned_shards(),
+                'consumed_queues': self._consumer.consumed_queues,
+            }
+        return status
+    
+    def rebalance(self, replicas: typing.Iterable[str]):
+        """
+        Rebalance the shards after a replica joined or left
+
+        This needs to be called on every replica with the identifiers of all replicas which are
+        currently running. Only the shards of the joined or left replicas are moved, so the
+        other shards stay on their replicas.
+
+        :param replicas: The identifiers of all replicas, including this replica
+        :type replicas: Iterable[str]
+        """
+        if self._sharding is None:
+            raise RuntimeError('The server does not use a sharded consumption')
+        self._sharding.rebalance(replicas)
+        self._consumer.rebalance()
     
     def raise_exceptions(self):
         """Raise a possible exception that was risen in a thread"""
         if self._error is not None:
             raise self._error
     
-    def stop_server(self):
-        """Stop the server and disconnect the underlying :class:`~.basicConsumer.BasicConsumer`"""
+    def stop_server(self, drain_timeout: float = 30.0):
+        """
+        Stop the server and disconnect the underlying :class:`~.basicConsumer.BasicConsumer`
+
+        If worker processes are used, the server stops receiving new messages and waits for the
+        running executions before disconnecting, so their responses can still be sent
+
+        :param drain_timeout: The maximum time in seconds to wait for executions running in
+            worker processes, defaults to 30 seconds
+        :type drain_timeout: float, optional
+        """
         self._stop_event.set()
+        if self._payload_transport is not None:
+            unfinished_executions = self._consumer.drain(drain_timeout)
+            if unfinished_executions > 0:
+                _logger.warning('%s executions did not finish before the server was stopped. '
+                                'Their messages were not acknowledged and will be redelivered '
+                                'by the message broker',
+                                unfinished_executions)
         self._consumer.stop()
         self._consumer_tread.join()
+        if self._payload_transport is not None:
+            self._payload_transport.shutdown()
+        if self._introspection_server is not None:
+            self._introspection_server.stop()
+        if self._recorder is not None:
+            self._recorder.close()
+        self._statistics.connection_state = _metrics.STATE_STOPPED
+    
+    def replay(
+            self,
+            record_file: str,
+            speed: typing.Optional[float] = 1.0
+    ) -> _recording.ReplayChannel:
+        """
+        Replay the deliveries of a record file into the executor without a message broker
+
+        The deliveries are handled like deliveries received from the message broker, including
+        the validation and the worker processes. The replay uses its own statistics and its own
+        worker processes, so the status of the server is not changed by the replay. The server
+        does not need to be started for a replay.
+
+        :param record_file: The path of the record file
+        :type record_file: str
+        :param speed: The factor by which the original rate of deliveries is scaled. If ``None``,
+            the deliveries are replayed as fast as possible, defaults to the original rate
+        :type speed: float, optional
+        :return: The channel stand-in containing the number of acknowledged, rejected and
+            answered deliveries and the statistics of the replay
+        :rtype: ~.recording.ReplayChannel
+        """
+        payload_transport: typing.Optional[_SharedMemoryTransport] = None
+        if self._worker_processes > 0:
+            payload_transport = _SharedMemoryTransport(
+                self._worker_processes, self._shared_memory_threshold
+            )
+        # The rejections counted by a validation pipeline are part of the status of the server
+        content_validator = self._content_validator
+        if isinstance(content_validator, ValidationPipeline):
+            content_validator = ValidationPipeline(
+                content_validator.max_size, content_validator.content_types,
+                content_validator.decoder, content_validator.schema
+            )
+        consumer = _BasicConsumer(
+            self._amqp_dsn, self._exchange_name, self._executor, content_validator,
+            self._queue_name, self._exchange_type, payload_transport, _metrics.ServerStatistics()
+        )
+        try:
+            return _recording.replay(record_file, consumer, speed)
+        finally:
+            if payload_transport is not None:
+                payload_transport.shutdown()
     
     def _start_with_reconnecting_loop(self):
         """Start the AMQP Server with a reconnecting logic when the BasicConsumer disconnects"""
         while not self._stop_event.is_set():
             try:
                 self._consumer.start()
-            except Exception:  # pylint: disable=broad-except
+            except Exception as error:  # pylint: disable=broad-except
+                self._statistics.record_error(error)
                 self._consumer.stop()
                 break
             self._reconnect()
@@ -160,6 +372,7 @@ class Server:
         if self._consumer.may_reconnect:
             if self._current_reconnection_attempts < self._max_reconnection_attempts:
                 _logger.info('Trying to reconnect to the message broker')
+                self._statistics.connection_state = _metrics.STATE_RECONNECTING
                 # Stop the currently running consumer
                 self._consumer.stop()
                 # Wait for 10 seconds
@@ -169,9 +382,11 @@ class Server:
                 # Create a new consumer
                 self._consumer = _BasicConsumer(
                     self._amqp_dsn, self._exchange_name, self._executor, self._content_validator,
-                    self._queue_name, self._exchange_type
+                    self._queue_name, self._exchange_type, self._payload_transport,
+                    self._statistics, self._recorder, self._sharding
                 )
                 self._current_reconnection_attempts += 1
+                self._statistics.reconnection_attempts = self._current_reconnection_attempts
             else:
                 _logger.critical('Unable to reconnect to the message broker. The maximum amount '
                                  'of reconnection attempts was reached')
@@ -179,3 +394,6 @@ class Server:
                 self._error_risen.set()
                 self._stop_event.set()
                 self._error = _MaxConnectionAttemptsReached()
+                # The last error stays the reason of the connection failure, since the state
+                # already shows that the server gave up reconnecting
+                self._statistics.connection_state = _metrics.STATE_FAILED
@@ -1,9 +1,13 @@
 """The basic consumer which consumes messages and relays them to an executor function"""
+import concurrent.futures
+import functools
 import json
 import logging
 import secrets
 import sys
-from typing import Optional, Callable
+import threading
+import time
+from typing import Optional, Callable, Dict, List, Union
 
 import pika
 import pika.channel
@@ -11,6 +15,12 @@ import pika.exceptions
 import pika.exchange_type
 import pika.frame
 
+from . import metrics
+from .payload_transport import SharedMemoryTransport
+from .recording import DeliveryRecorder
+from .sharding import CONSISTENT_HASH_EXCHANGE_TYPE, ShardingConfiguration
+from .validation import ValidationPipeline
+
 
 class BasicConsumer:
     """The basic consumer handling the connection to the message broker and the running of the
@@ -21,9 +31,13 @@ class BasicConsumer:
             amqp_dsn: str,
             exchange_name: str,
             executor: Callable[[bytes], bytes],
-            content_validator: Optional[Callable[[bytes], bool]] = None,
+            content_validator: Optional[Union[Callable[[bytes], bool], ValidationPipeline]] = None,
             queue_name: str = secrets.token_urlsafe(nbytes=32),
-            exchange_type: pika.exchange_type.ExchangeType = pika.exchange_type.ExchangeType.fanout
+            exchange_type: pika.exchange_type.ExchangeType = pika.exchange_type.ExchangeType.fanout,
+            payload_transport: Optional[SharedMemoryTransport] = None,
+            statistics: Optional[metrics.ServerStatistics] = None,
+            recorder: Optional[DeliveryRecorder] = None,
+            sharding: Optional[ShardingConfiguration] = None
     ):
         """
         Initialize a new BasicConsumer
@@ -42,8 +56,10 @@ class BasicConsumer:
         :type executor: Callable[[bytes], bytes]
         :param content_validator: A callable which returns if the content of the message is
             valid for the executor. If the callable returns `False` the message will be rejected.
-            If no content_validator is supplied the message will always be acknowledged
-        :type content_validator: Callable[[bytes], bool], optional
+            If no content_validator is supplied the message will always be acknowledged. If a
+            :class:`~.validation.ValidationPipeline` is supplied, the content decoded by the
+            pipeline will be passed to the executor
+        :type content_validator: Callable[[bytes], bool] | ValidationPipeline, optional
         :param queue_name: The name of the queue which shall be bound to the exchange by this
             consumer. If no queue name is supplied a name will be autogenerated
         :type queue_name: str, optional
@@ -51,7 +67,22 @@ class BasicConsumer:
             exist. If the exchange already exists, the exchange_type needs to match the one which
             has already been declared
         :type exchange_type: pika.exchange_type.ExchangeType, optional
-        :type queue_name: str, optional
+        :param payload_transport: A transport which runs the executor in worker processes. If
+            a transport is supplied, the executor needs to be picklable and as many messages as
+            the transport has workers will be prefetched from the message broker. The messages
+            are acknowledged once the worker has finished, so no more messages than the
+            transport has workers are handled at once
+        :type payload_transport: SharedMemoryTransport, optional
+        :param statistics: The statistics which shall be updated by this consumer. If no
+            statistics are supplied, the consumer will create its own statistics
+        :type statistics: metrics.ServerStatistics, optional
+        :param recorder: A recorder which writes every received delivery into a record file
+        :type recorder: DeliveryRecorder, optional
+        :param sharding: The configuration for a sharded consumption. If a configuration is
+            supplied, the exchange will be declared as consistent hash exchange, the queue will
+            be split into shard queues and only the shards assigned to this replica will be
+            consumed. The exchange_type will be ignored
+        :type sharding: ShardingConfiguration, optional
         """
         # Check if the AMQP Data Source Name is not None or emtpy
         if amqp_dsn is None:
@@ -73,17 +104,43 @@ class BasicConsumer:
         self._queue_name = queue_name
         self._executor = executor
         self._content_validator = content_validator
+        self._payload_transport = payload_transport
+        self.statistics = statistics if statistics is not None else metrics.ServerStatistics()
+        self._recorder = recorder
+        self._sharding = sharding
         # Create a logger for the consumer
         self._logger = logging.getLogger('amqp_rpc_server.basic_consumer.BasicConsumer')
         # Initialize some attributes which are needed later and apply typing to them
         self._connection: Optional[pika.SelectConnection] = None
         self._channel: Optional[pika.channel.Channel] = None
-        self._qos_prefetch_count = 1
-        self._consumer_tag = None
+        self._qos_prefetch_count = 1 if payload_transport is None else payload_transport.workers
+        self._consumer_tags: Dict[str, str] = {}
         self._is_consuming = False
         self._is_closing = False
         self.may_reconnect = False
     
+    @property
+    def is_consuming(self) -> bool:
+        """Indicates if the consumer is currently consuming messages"""
+        return self._is_consuming
+    
+    @property
+    def consumed_queues(self) -> List[str]:
+        """The names of the queues which are currently consumed"""
+        return list(self._consumer_tags)
+    
+    def rebalance(self):
+        """
+        Apply a changed shard assignment of the sharding configuration
+
+        The consumption of the shards which are not assigned to this replica anymore will be
+        cancelled and the consumption of newly assigned shards will be started. This method may
+        be called from any thread.
+        """
+        if self._sharding is None or not self._is_consuming:
+            return
+        self._connection.ioloop.add_callback_threadsafe(self._apply_shard_assignment)
+    
     def start(self):
         """Start the consumer by connecting to the message broker"""
         self._connection = self._connect()
@@ -114,21 +171,68 @@ class BasicConsumer:
             self._logger.info('Stopped the consumer and closed the connection to the message '
                               'broker')
     
+    def drain(self, timeout: float) -> int:
+        """
+        Stop receiving new messages and wait for the executions running in worker processes
+
+        The channel stays open, so the responses of the running executions can still be sent.
+        This method may be called from any thread.
+
+        :param timeout: The maximum time in seconds to wait for the running executions
+        :type timeout: float
+        :return: The number of executions which did not finish before the timeout
+        :rtype: int
+        """
+        if not self._is_consuming:
+            return self.statistics.in_flight
+        deadline = time.monotonic() + timeout
+        try:
+            self._connection.ioloop.add_callback_threadsafe(self._cancel_consumers)
+            while self.statistics.in_flight > 0 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            # The callbacks are run in order, so all responses of the finished executions have
+            # been published once this callback was run
+            responses_published = threading.Event()
+            self._connection.ioloop.add_callback_threadsafe(responses_published.set)
+            responses_published.wait(max(deadline - time.monotonic(), 1.0))
+        except Exception as error:  # pylint: disable=broad-except
+            self._logger.warning('Unable to drain the consumer: %s', error)
+        return self.statistics.in_flight
+    
+    def _cancel_consumers(self):
+        """Cancel the consumption of all queues without closing the channel"""
+        if self._channel is None:
+            return
+        for consumer_tag in self._consumer_tags.values():
+            self._channel.basic_cancel(consumer_tag)
+        self._consumer_tags.clear()
+    
     def _stop_consuming(self):
         """Stop the consumption of messages"""
         if self._channel:
             self._logger.debug('Cancelling the active channel to the message broker')
-            self._channel.basic_cancel(self._consumer_tag, self._cb_channel_cancelled)
+            if not self._consumer_tags:
+                self._close_channel()
+            for queue_name, consumer_tag in list(self._consumer_tags.items()):
+                self._channel.basic_cancel(
+                    consumer_tag, functools.partial(self._cb_channel_cancelled, queue_name)
+                )
     
-    def _cb_channel_cancelled(self, method_frame: pika.frame.Method):
+    def _cb_channel_cancelled(self, queue_name: str, method_frame: pika.frame.Method):
         """
         Callback invoked if a channel has successfully been cancelled
 
+        The channel will be closed as soon as the consumption of all queues has been cancelled
+
+        :param queue_name: The name of the queue whose consumption has been cancelled
+        :type queue_name: str
         :param method_frame: The result of the execution
         :type method_frame: pika.frame.Method
         """
         self._logger.debug('Successfully cancelled the channel at the message broker')
-        self._close_channel()
+        self._consumer_tags.pop(queue_name, None)
+        if not self._consumer_tags:
+            self._close_channel()
     
     def _close_channel(self):
         """Close the currently active channel"""
@@ -142,6 +246,7 @@ class BasicConsumer:
         :rtype: pika.SelectConnection
         """
         self._logger.info('Connecting to the message broker...')
+        self.statistics.connection_state = metrics.STATE_CONNECTING
         self._logger.debug('Connection DSN: %s',
                            self._amqp_dsn)
         # Build the connection parameters
@@ -173,6 +278,8 @@ class BasicConsumer:
         """
         self._logger.critical('Failed to establish a connection to the message broker: %s',
                               reason)
+        self.statistics.connection_state = metrics.STATE_DISCONNECTED
+        self.statistics.record_error(reason)
         self.may_reconnect = True
         self.stop()
         return
@@ -188,12 +295,15 @@ class BasicConsumer:
         """
         # Unset the channel so no more messages can be sent
         self._channel = None
+        self._is_consuming = False
+        self.statistics.connection_state = metrics.STATE_DISCONNECTED
         if self._is_closing:
             self._connection.ioloop.stop()
         else:
             self._logger.error('The connection to the message broker was closed unexpectedly for '
                                'the following reason: %s',
                                reason)
+            self.statistics.record_error(reason)
             self.may_reconnect = True
     
     def _cb_connection_opened(self, connection: pika.BaseConnection):
@@ -203,6 +313,7 @@ class BasicConsumer:
         :type connection: pika.SelectConnection
         """
         self._logger.debug('Connected to the message broker')
+        self.statistics.connection_state = metrics.STATE_CONNECTED
         self._logger.debug('Server properties: %s',
                            connection.params.client_properties)
         # Call for opening a channel
@@ -228,6 +339,7 @@ class BasicConsumer:
         """Callback for how to handle a closed channel"""
         if isinstance(reason, pika.exceptions.ChannelClosedByBroker):
             self._logger.critical('The message broker closed the currently active channel')
+            self.statistics.record_error(reason)
             self.may_reconnect = True
             self._is_closing = True
             self._close_connection()
@@ -237,6 +349,7 @@ class BasicConsumer:
         else:
             self._logger.critical('The channel was closed for an not handled error: %s',
                                   reason)
+            self.statistics.record_error(reason)
             self._is_closing = True
             self.may_reconnect = True
             self._close_connection()
@@ -246,6 +359,14 @@ class BasicConsumer:
         self._logger.debug('Declaring an exchange on the message broker...')
         self._logger.debug('Exchange Name: %s',
                            self._exchange_name)
+        if self._sharding is not None:
+            self._channel.exchange_declare(
+                exchange=self._exchange_name,
+                exchange_type=CONSISTENT_HASH_EXCHANGE_TYPE,
+                arguments=self._sharding.exchange_arguments,
+                callback=self._cb_exchange_declared
+            )
+            return
         self._channel.exchange_declare(
             exchange=self._exchange_name,
             exchange_type=self._exchange_type.value,
@@ -266,26 +387,65 @@ class BasicConsumer:
         self._logger.debug('Successfully declared an exchange on the message broker')
         self._logger.debug('Method Frame Contents: %s',
                            method_frame)
-        self._setup_queue()
+        self._setup_queue(self._declared_queue_names())
     
-    def _setup_queue(self):
-        """Set up a queue which is attached to the exchange"""
+    def _declared_queue_names(self) -> List[str]:
+        """
+        Get the names of the queues which are declared and bound to the exchange
+
+        :return: The name of the queue or the names of all shard queues
+        :rtype: list[str]
+        """
+        if self._sharding is None:
+            return [self._queue_name]
+        return [
+            self._sharding.shard_queue_name(self._queue_name, shard)
+            for shard in range(self._sharding.shard_count)
+        ]
+    
+    def _consumed_queue_names(self) -> List[str]:
+        """
+        Get the names of the queues which shall be consumed
+
+        :return: The name of the queue or the names of the shard queues assigned to this replica
+        :rtype: list[str]
+        """
+        if self._sharding is None:
+            return [self._queue_name]
+        return [
+            self._sharding.shard_queue_name(self._queue_name, shard)
+            for shard in self._sharding.assigned_shards()
+        ]
+    
+    def _setup_queue(self, pending_queue_names: List[str]):
+        """
+        Set up a queue which is attached to the exchange
+
+        :param pending_queue_names: The names of the queues which still need to be set up. The
+            first queue will be set up now and the remaining queues after it has been bound
+        :type pending_queue_names: list[str]
+        """
         self._logger.debug('Setting up a queue at the message broker...')
+        # Only one replica may consume a shard at once, even while the shards are rebalanced
+        arguments = None if self._sharding is None else {'x-single-active-consumer': True}
         self._channel.queue_declare(
-            self._queue_name,
+            pending_queue_names[0],
             passive=False,
             exclusive=False,
             auto_delete=False,
             durable=True,
-            callback=self._cb_queue_declared
+            arguments=arguments,
+            callback=functools.partial(self._cb_queue_declared, pending_queue_names)
         )
     
-    def _cb_queue_declared(self, method_frame: pika.frame.Method):
+    def _cb_queue_declared(self, pending_queue_names: List[str], method_frame: pika.frame.Method):
         """
         Callback for a successfully created queue
 
         This callback will initiate the binding of the queue to the exchange
 
+        :param pending_queue_names: The names of the queues which still need to be set up
+        :type pending_queue_names: list[str]
         :param method_frame: Status of the Method
         :type method_frame: pika.frame.Method, unused
         """
@@ -293,26 +453,34 @@ class BasicConsumer:
         self._logger.debug('Method Frame Contents: %s',
                            method_frame)
         self._logger.debug('Binding the queue to the specified/created exchange...')
-        # Currently, there will be no routing key set since I'm not sure on how I want to
-        # implement the different exchange types
+        # Currently, there will be no routing key set for unsharded queues since I'm not sure
+        # on how I want to implement the different exchange types. For a consistent hash
+        # exchange the routing key is the weight of the shard
         self._channel.queue_bind(
-            queue=self._queue_name,
+            queue=pending_queue_names[0],
             exchange=self._exchange_name,
-            callback=self._cb_queue_bound
+            routing_key=None if self._sharding is None else '1',
+            callback=functools.partial(self._cb_queue_bound, pending_queue_names)
         )
     
-    def _cb_queue_bound(self, method_frame: pika.frame.Method):
+    def _cb_queue_bound(self, pending_queue_names: List[str], method_frame: pika.frame.Method):
         """
         Callback for a successful execution of the queue binding
 
-        This will trigger a setup for the quality of service on this consumer
+        This will trigger the setup of the next pending queue or, if all queues have been set
+        up, a setup for the quality of service on this consumer
 
+        :param pending_queue_names: The names of the queues which still need to be set up
+        :type pending_queue_names: list[str]
         :param method_frame: The result of the execution
         :type method_frame: pika.frame.Method
         """
         self._logger.debug('Successfully bound the queue to the exchange')
         self._logger.debug('Method Frame Contents: %s',
                            method_frame)
+        if len(pending_queue_names) > 1:
+            self._setup_queue(pending_queue_names[1:])
+            return
         self._logger.debug('Setting the Quality of service for this consumer')
         self._channel.basic_qos(
             prefetch_count=self._qos_prefetch_count,
@@ -341,13 +509,43 @@ class BasicConsumer:
         self._logger.info('Enabling the message consumption')
         self._channel.add_on_cancel_callback(self._cb_consumer_cancelled)
         self._is_consuming = True
-        self._consumer_tag = self._channel.basic_consume(
-            self._queue_name,
+        self.statistics.connection_state = metrics.STATE_CONSUMING
+        for queue_name in self._consumed_queue_names():
+            self._consume_queue(queue_name)
+    
+    def _consume_queue(self, queue_name: str):
+        """
+        Start consuming messages from a queue
+
+        :param queue_name: The name of the queue
+        :type queue_name: str
+        """
+        self._logger.debug('Consuming messages from the queue: %s',
+                           queue_name)
+        self._consumer_tags[queue_name] = self._channel.basic_consume(
+            queue_name,
             on_message_callback=self._cb_new_message_received,
             exclusive=False,
             auto_ack=False
         )
     
+    def _apply_shard_assignment(self):
+        """Cancel the consumption of released shards and consume the newly assigned shards"""
+        if self._channel is None or not self._is_consuming or self._is_closing:
+            return
+        assigned_queue_names = self._consumed_queue_names()
+        for queue_name in list(self._consumer_tags):
+            if queue_name not in assigned_queue_names:
+                self._logger.info('Releasing the shard queue: %s',
+                                  queue_name)
+                consumer_tag = self._consumer_tags.pop(queue_name)
+                self._channel.basic_cancel(consumer_tag)
+        for queue_name in assigned_queue_names:
+            if queue_name not in self._consumer_tags:
+                self._logger.info('Taking over the shard queue: %s',
+                                  queue_name)
+                self._consume_queue(queue_name)
+    
     def _cb_consumer_cancelled(self, method_frame: pika.frame.Method):
         """
         Callback invoked if a consumer is cancelled by the message broker
@@ -386,6 +584,10 @@ class BasicConsumer:
         :param message_body: The content of the message
         :type message_body: bytes
         """
+        received_at = time.monotonic()
+        self.statistics.message_received()
+        if self._recorder is not None:
+            self._recorder.record(message_properties, message_body)
         # Try to extract an app_id from the message properties for more accurate logging
         _sender_id = 'unknown' if message_properties.app_id is None else message_properties.app_id
         self._logger.info('%s - %s - Received new message from the message broker by sent by: %s',
@@ -397,11 +599,18 @@ class BasicConsumer:
                                  _sender_id, delivery_properties.delivery_tag)
             # Reject the message
             channel.basic_reject(delivery_properties.delivery_tag, requeue=False)
+            self.statistics.message_rejected()
             return
         # Since the required properties were found the message will now be passed to the
         # validator, if a validator was supplied
         message_valid = True
-        if self._content_validator is not None:
+        message_content = message_body
+        rejection_reason = None
+        if isinstance(self._content_validator, ValidationPipeline):
+            message_valid, rejection_reason, message_content = self._content_validator.validate(
+                message_body, message_properties
+            )
+        elif self._content_validator is not None:
             message_valid = self._content_validator(message_body)
         if not message_valid:
             self._logger.warning('%s - %s - The message was deemed invalid by the validator. The '
@@ -409,10 +618,13 @@ class BasicConsumer:
                                  _sender_id, delivery_properties.delivery_tag)
             # Reject
             channel.basic_reject(delivery_properties.delivery_tag, requeue=False)
+            self.statistics.message_rejected()
             # Build the information for the sender
             _invalid_message_notification = {
                 "error": "invalid_message_content"
             }
+            if rejection_reason is not None:
+                _invalid_message_notification["reason"] = rejection_reason
             # Send a message back to the sender
             channel.basic_publish(
                 exchange='',
@@ -425,18 +637,150 @@ class BasicConsumer:
             )
             return
 
+        self.statistics.execution_started()
+        # If a payload transport is available the executor will be run in a worker process and
+        # the response will be sent as soon as the worker has finished. The message is only
+        # acknowledged once the worker has finished, so the prefetch count limits the number of
+        # messages handed to the workers
+        if self._payload_transport is not None:
+            try:
+                execution = self._payload_transport.submit(self._executor, message_content)
+            except Exception as error:  # pylint: disable=broad-except
+                self._logger.error('%s - %s - Unable to pass the message to a worker process: %s',
+                                   _sender_id, delivery_properties.delivery_tag, error)
+                self.statistics.execution_finished(received_at)
+                self._finish_delivery(
+                    channel, delivery_properties.delivery_tag, message_properties,
+                    self._build_error_response(error)
+                )
+                return
+            execution.add_done_callback(
+                functools.partial(
+                    self._cb_execution_finished, channel, delivery_properties.delivery_tag,
+                    message_properties, received_at
+                )
+            )
+            return
+        # Since the message is valid it now will be acknowledged
+        channel.basic_ack(delivery_properties.delivery_tag)
         # Now run the executor and get its results and catch all errors happening which are not
         # explicitly caught during the execution
         try:
-            # Since the message is valid it now will be acknowledged
-            channel.basic_ack(delivery_properties.delivery_tag)
-            results = self._executor(message_body)
+            results = self._executor(message_content)
         except Exception as error:  # pylint: disable=broad-except
-            # Since an error occurred we now put the information from the error into the response
-            exception_data = {
-                "error": str(error)
-            }
-            results = json.dumps(exception_data, ensure_ascii=False).encode('utf-8')
+            results = self._build_error_response(error)
+        finally:
+            self.statistics.execution_finished(received_at)
+        self._publish_response(channel, message_properties, results)
+        return
+
+    def _cb_execution_finished(
+            self,
+            channel: pika.channel.Channel,
+            delivery_tag: int,
+            message_properties: pika.spec.BasicProperties,
+            received_at: float,
+            execution: concurrent.futures.Future
+    ):
+        """
+        Callback invoked in a thread of the payload transport once a worker finished executing
+
+        Since the channel is not thread-safe, the message will be acknowledged and the response
+        will be published from the ioloop of the connection
+
+        :param channel: The channel over which the message was received
+        :type channel: pika.channel.Channel
+        :param delivery_tag: The delivery tag of the message
+        :type delivery_tag: int
+        :param message_properties: The properties of the message
+        :type message_properties: pika.spec.BasicProperties
+        :param received_at: The value of :func:`time.monotonic` when the message was received
+        :type received_at: float
+        :param execution: The finished execution of the executor
+        :type execution: concurrent.futures.Future
+        """
+        error = execution.exception()
+        results = execution.result() if error is None else self._build_error_response(error)
+        try:
+            self._connection.ioloop.add_callback_threadsafe(
+                functools.partial(
+                    self._finish_delivery, channel, delivery_tag, message_properties, results
+                )
+            )
+        except Exception as error:  # pylint: disable=broad-except
+            self._logger.error('%s - Unable to send the response since the connection to the '
+                               'message broker is not available anymore. The message will be '
+                               'redelivered by the message broker: %s',
+                               message_properties.correlation_id, error)
+        finally:
+            # The execution is counted as finished here, since the ioloop may be stopped before
+            # the response is published
+            self.statistics.execution_finished(received_at)
+
+    def _finish_delivery(
+            self,
+            channel: pika.channel.Channel,
+            delivery_tag: int,
+            message_properties: pika.spec.BasicProperties,
+            results: bytes
+    ):
+        """
+        Acknowledge a message handled by a worker process and send the response to the sender
+
+        :param channel: The channel over which the message was received
+        :type channel: pika.channel.Channel
+        :param delivery_tag: The delivery tag of the message
+        :type delivery_tag: int
+        :param message_properties: The properties of the message
+        :type message_properties: pika.spec.BasicProperties
+        :param results: The results of the executor
+        :type results: bytes
+        """
+        if not channel.is_open:
+            self._logger.error('%s - Unable to acknowledge the message since the channel has '
+                               'been closed. The message will be redelivered by the message '
+                               'broker',
+                               message_properties.correlation_id)
+            return
+        channel.basic_ack(delivery_tag)
+        self._publish_response(channel, message_properties, results)
+
+    @staticmethod
+    def _build_error_response(error: BaseException) -> bytes:
+        """
+        Put the information from an error which occurred during the execution into a response
+
+        :param error: The error raised by the executor
+        :type error: BaseException
+        :return: The response describing the error
+        :rtype: bytes
+        """
+        exception_data = {
+            "error": str(error)
+        }
+        return json.dumps(exception_data, ensure_ascii=False).encode('utf-8')
+
+    def _publish_response(
+            self,
+            channel: pika.channel.Channel,
+            message_properties: pika.spec.BasicProperties,
+            results: bytes
+    ):
+        """
+        Send the results of the executor back to the sender of the message
+
+        :param channel: The channel over which the message was received
+        :type channel: pika.channel.Channel
+        :param message_properties: The properties of the message
+        :type message_properties: pika.spec.BasicProperties
+        :param results: The results of the executor
+        :type results: bytes
+        """
+        if not channel.is_open:
+            self._logger.error('%s - Unable to send the response since the channel has been '
+                               'closed',
+                               message_properties.correlation_id)
+            return
         # Send the response to the message broker
         channel.basic_publish(
             exchange='',
@@ -447,7 +791,6 @@ class BasicConsumer:
                 content_encoding='utf-8'
             )
         )
-        return
 
     def _close_connection(self):
         self._consuming = False
@@ -0,0 +1,111 @@
+"""A lightweight HTTP endpoint reporting the health, readiness and statistics of a server"""
+import http.server
+import json
+import logging
+import socketserver
+import threading
+import typing
+
+_logger = logging.getLogger(__name__)
+
+HEALTH_PATH = '/health'
+"""Responds with ``200`` if the server is alive and did not give up reconnecting"""
+
+READINESS_PATH = '/ready'
+"""Responds with ``200`` if the server is currently consuming messages"""
+
+STATUS_PATH = '/status'
+"""Responds with the complete status of the server"""
+
+
+class _IntrospectionRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handle the requests sent to the introspection endpoint"""
+
+    server: 'IntrospectionServer'
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Respond with the status of the server"""
+        path = self.path.split('?', 1)[0].rstrip('/')
+        if path not in (HEALTH_PATH, READINESS_PATH, STATUS_PATH):
+            self._send_json(404, {'error': 'not_found'})
+            return
+        try:
+            status = self.server.status_provider()
+        except Exception as error:  # pylint: disable=broad-except
+            _logger.error('Unable to collect the status of the server: %s', error)
+            self._send_json(500, {'error': str(error)})
+            return
+        if path == HEALTH_PATH:
+            self._send_json(200 if status['healthy'] else 503, {'healthy': status['healthy']})
+        elif path == READINESS_PATH:
+            self._send_json(200 if status['ready'] else 503, {'ready': status['ready']})
+        else:
+            self._send_json(200, status)
+
+    def _send_json(self, status_code: int, content: typing.Dict[str, typing.Any]):
+        """
+        Send a JSON response
+
+        :param status_code: The HTTP status code of the response
+        :type status_code: int
+        :param content: The content of the response
+        :type content: dict
+        """
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Log the requests with the logger of this module instead of writing to stderr"""
+        _logger.debug(format, *args)
+
+
+class IntrospectionServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """An HTTP server exposing the health, readiness and status of a server"""
+
+    daemon_threads = True
+
+    def __init__(
+            self,
+            status_provider: typing.Callable[[], typing.Dict[str, typing.Any]],
+            host: str = '127.0.0.1',
+            port: int = 0
+    ):
+        """
+        Initialize a new introspection server and bind it to the address
+
+        :param status_provider: A callable returning the current status. The status needs to
+            contain the keys ``healthy`` and ``ready``
+        :type status_provider: Callable[[], dict]
+        :param host: The host the endpoint is bound to, defaults to ``127.0.0.1``
+        :type host: str, optional
+        :param port: The port the endpoint is bound to. If the port is ``0`` a free port will be
+            chosen, defaults to ``0``
+        :type port: int, optional
+        """
+        super().__init__((host, port), _IntrospectionRequestHandler)
+        self.status_provider = status_provider
+        self._serving_thread: typing.Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        """The port the introspection endpoint is bound to"""
+        return self.server_address[1]
+
+    def start(self):
+        """Start serving requests in a background thread"""
+        self._serving_thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._serving_thread.start()
+        _logger.info('Serving the introspection endpoint on %s:%s',
+                     self.server_address[0], self.port)
+
+    def stop(self):
+        """Stop serving requests and close the socket"""
+        if self._serving_thread is not None:
+            self.shutdown()
+            self._serving_thread.join()
+            self._serving_thread = None
+        self.server_close()
@@ -0,0 +1,154 @@
+"""Statistics about the messages handled by the server and the state of its connection"""
+import collections
+import threading
+import time
+import typing
+
+STATE_INITIALIZED = 'initialized'
+"""The server has been created but was not started yet"""
+
+STATE_CONNECTING = 'connecting'
+"""The consumer is connecting to the message broker"""
+
+STATE_CONNECTED = 'connected'
+"""The consumer is connected and is setting up the exchange and the queue"""
+
+STATE_CONSUMING = 'consuming'
+"""The consumer is consuming messages"""
+
+STATE_DISCONNECTED = 'disconnected'
+"""The connection to the message broker was lost or could not be established"""
+
+STATE_RECONNECTING = 'reconnecting'
+"""The server waits before reconnecting to the message broker"""
+
+STATE_STOPPED = 'stopped'
+"""The server has been stopped"""
+
+STATE_FAILED = 'failed'
+"""The server gave up reconnecting to the message broker"""
+
+
+class ServerStatistics:
+    """Thread-safe collection of statistics about the handled messages
+
+    The statistics are shared between all consumers created by a server, so they are kept
+    across reconnects. Throughput and latency are calculated over a sliding window of recently
+    finished executions.
+    """
+
+    def __init__(self, window: float = 60.0, max_samples: int = 10000):
+        """
+        Initialize new and empty statistics
+
+        :param window: The length of the sliding window in seconds used for the calculation of
+            the throughput and latency, defaults to 60 seconds
+        :type window: float, optional
+        :param max_samples: The maximum number of finished executions kept in the sliding window,
+            defaults to 10000
+        :type max_samples: int, optional
+        """
+        if window <= 0:
+            raise ValueError('The window needs to be longer than zero seconds')
+        if max_samples < 1:
+            raise ValueError('The max_samples need to be at least one')
+        self._window = window
+        self._max_samples = max_samples
+        self._lock = threading.Lock()
+        self._finished_executions: typing.Deque[typing.Tuple[float, float]] = collections.deque(
+            maxlen=max_samples
+        )
+        self.connection_state = STATE_INITIALIZED
+        self.reconnection_attempts = 0
+        self._received = 0
+        self._rejected = 0
+        self._completed = 0
+        self._in_flight = 0
+        self._last_error: typing.Optional[str] = None
+        self._last_error_time: typing.Optional[float] = None
+
+    @property
+    def in_flight(self) -> int:
+        """The number of messages which are currently handled by the executor"""
+        with self._lock:
+            return self._in_flight
+
+    def message_received(self):
+        """Count a message which was received from the message broker"""
+        with self._lock:
+            self._received += 1
+
+    def message_rejected(self):
+        """Count a message which was rejected"""
+        with self._lock:
+            self._rejected += 1
+
+    def execution_started(self):
+        """Count a message which is now handled by the executor"""
+        with self._lock:
+            self._in_flight += 1
+
+    def execution_finished(self, received_at: float):
+        """
+        Count a message for which the executor finished
+
+        :param received_at: The value of :func:`time.monotonic` when the message was received
+        :type received_at: float
+        """
+        finished_at = time.monotonic()
+        with self._lock:
+            self._in_flight -= 1
+            self._completed += 1
+            self._finished_executions.append((finished_at, finished_at - received_at))
+
+    def record_error(self, error: typing.Union[BaseException, str]):
+        """
+        Remember the last error which occurred
+
+        :param error: The error or a description of the error
+        :type error: BaseException | str
+        """
+        with self._lock:
+            self._last_error = error if isinstance(error, str) else repr(error)
+            self._last_error_time = time.time()
+
+    def snapshot(self) -> typing.Dict[str, typing.Any]:
+        """
+        Create a snapshot of the current statistics
+
+        :return: The statistics as a JSON serializable dictionary. Latencies are in seconds and
+            the throughput is in messages per second
+        :rtype: dict
+        """
+        now = time.monotonic()
+        with self._lock:
+            while self._finished_executions and \
+                    self._finished_executions[0][0] < now - self._window:
+                self._finished_executions.popleft()
+            latencies = sorted(latency for _, latency in self._finished_executions)
+            # If the samples were truncated, the throughput is calculated over the time span
+            # covered by the remaining samples
+            window = self._window
+            if len(latencies) == self._max_samples:
+                window = max(now - self._finished_executions[0][0], 1e-9)
+            statistics = {
+                'connection_state':      self.connection_state,
+                'reconnection_attempts': self.reconnection_attempts,
+                'messages':              {
+                    'received':  self._received,
+                    'rejected':  self._rejected,
+                    'completed': self._completed,
+                    'in_flight': self._in_flight,
+                },
+                'throughput':            len(latencies) / window,
+                'latency':               {
+                    'mean': sum(latencies) / len(latencies) if latencies else None,
+                    'p95':  latencies[int(0.95 * (len(latencies) - 1))] if latencies else None,
+                    'max':  latencies[-1] if latencies else None,
+                },
+                'last_error':            None if self._last_error is None else {
+                    'message':   self._last_error,
+                    'timestamp': self._last_error_time,
+                },
+            }
+        return statistics
@@ -0,0 +1,250 @@
+"""Transport of message payloads to executors running in worker processes
+
+Large message bodies are placed into shared memory blocks and only a small handle pointing to
+the block is sent to the worker process. This avoids pickling the message body and copying it
+through the pipe of the process pool. The results of the executor are returned in the same way.
+"""
+import concurrent.futures
+import concurrent.futures.process
+import logging
+import os
+import threading
+import typing
+
+try:
+    from multiprocessing import shared_memory as _shared_memory
+except ImportError:  # pragma: no cover - Python versions before 3.8
+    _shared_memory = None
+
+try:
+    from multiprocessing import resource_tracker as _resource_tracker
+except ImportError:  # pragma: no cover - Python versions before 3.8
+    _resource_tracker = None
+
+if os.name == 'nt':  # pragma: no cover - Windows does not track shared memory blocks
+    _resource_tracker = None
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_SHARED_MEMORY_THRESHOLD = 64 * 1024
+"""The payload size in bytes from which on a payload is transported via shared memory"""
+
+_SHARED_RESULTS = os.name != 'nt'
+"""Indicates if results may be returned via shared memory. On Windows a shared memory block is
+destroyed as soon as the last handle to it is closed, which happens when the worker returns"""
+
+
+class SharedPayload(typing.NamedTuple):
+    """A handle pointing to a payload which has been placed into a shared memory block"""
+
+    name: str
+    """The name of the shared memory block"""
+
+    size: int
+    """The size of the payload in bytes"""
+
+
+def _put_payload(payload: bytes) -> '_shared_memory.SharedMemory':
+    """
+    Create a new shared memory block and copy the payload into it
+
+    :param payload: The payload which shall be placed into shared memory
+    :type payload: bytes
+    :return: The shared memory block containing the payload
+    :rtype: multiprocessing.shared_memory.SharedMemory
+    """
+    # A shared memory block may not have a size of zero
+    block = _shared_memory.SharedMemory(create=True, size=max(len(payload), 1))
+    block.buf[:len(payload)] = payload
+    return block
+
+
+def _take_payload(handle: SharedPayload, unlink: bool) -> bytes:
+    """
+    Read a payload from the shared memory block the handle points to
+
+    :param handle: The handle pointing to the shared memory block
+    :type handle: SharedPayload
+    :param unlink: Release the shared memory block after the payload has been read
+    :type unlink: bool
+    :return: The payload stored in the shared memory block
+    :rtype: bytes
+    """
+    block = _shared_memory.SharedMemory(name=handle.name)
+    try:
+        return bytes(block.buf[:handle.size])
+    finally:
+        block.close()
+        if unlink:
+            block.unlink()
+
+
+def _execute_in_worker(
+        executor: typing.Callable[[bytes], bytes],
+        payload: typing.Union[bytes, SharedPayload],
+        threshold: int
+) -> typing.Union[bytes, SharedPayload]:
+    """
+    Run the executor inside a worker process
+
+    :param executor: The executor which shall handle the payload
+    :type executor: Callable[[bytes], bytes]
+    :param payload: The message body or a handle pointing to the message body
+    :type payload: bytes | SharedPayload
+    :param threshold: The result size from which on the result is returned via shared memory
+    :type threshold: int
+    :return: The result of the executor or a handle pointing to the result
+    :rtype: bytes | SharedPayload
+    """
+    if isinstance(payload, SharedPayload):
+        payload = _take_payload(payload, unlink=False)
+    results = executor(payload)
+    if _SHARED_RESULTS and isinstance(results, bytes) and len(results) >= threshold:
+        block = _put_payload(results)
+        block.close()
+        return SharedPayload(block.name, len(results))
+    return results
+
+
+class SharedMemoryTransport:
+    """Run executors in a pool of worker processes and exchange large payloads via shared
+    memory"""
+
+    def __init__(
+            self,
+            workers: typing.Optional[int] = None,
+            threshold: int = DEFAULT_SHARED_MEMORY_THRESHOLD
+    ):
+        """
+        Initialize a new transport with its own pool of worker processes
+
+        :param workers: The number of worker processes, defaults to :func:`os.cpu_count`
+        :type workers: int, optional
+        :param threshold: The payload size in bytes from which on payloads are placed into
+            shared memory. Smaller payloads are pickled since the setup of a shared memory block
+            is more expensive than copying them, defaults to
+            :data:`DEFAULT_SHARED_MEMORY_THRESHOLD`
+        :type threshold: int, optional
+        """
+        if _shared_memory is None:
+            raise RuntimeError('The shared memory transport requires Python 3.8 or newer')
+        if workers is not None and workers < 1:
+            raise ValueError('The number of workers needs to be at least one')
+        if threshold < 0:
+            raise ValueError('The threshold may not be negative')
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self._threshold = threshold
+        # The resource tracker needs to run before the workers are started. Otherwise, every
+        # worker starts its own tracker which reports the blocks unlinked by this process as
+        # leaked
+        if _resource_tracker is not None:
+            _resource_tracker.ensure_running()
+        # Limit the executions handed to the pool to the number of workers, so no more shared
+        # memory blocks than workers exist for the message bodies
+        self._slots = threading.BoundedSemaphore(self.workers)
+        self._pool_lock = threading.Lock()
+        self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+
+    def submit(
+            self,
+            executor: typing.Callable[[bytes], bytes],
+            message_body: bytes
+    ) -> concurrent.futures.Future:
+        """
+        Run the executor for the message body in a worker process
+
+        The executor needs to be picklable, e.g. a function defined on the module level. If
+        all workers are busy, the call blocks until a worker has finished.
+
+        :param executor: The executor which shall handle the message body
+        :type executor: Callable[[bytes], bytes]
+        :param message_body: The content of the message
+        :type message_body: bytes
+        :return: A future resolving to the results of the executor
+        :rtype: concurrent.futures.Future
+        """
+        self._slots.acquire()
+        block = None
+        payload = message_body
+        try:
+            if isinstance(message_body, bytes) and len(message_body) >= self._threshold:
+                block = _put_payload(message_body)
+                payload = SharedPayload(block.name, len(message_body))
+            worker_future = self._submit_to_pool(executor, payload)
+        except Exception:
+            if block is not None:
+                block.close()
+                block.unlink()
+            self._slots.release()
+            raise
+        results_future = concurrent.futures.Future()
+
+        def _cb_worker_finished(finished_future: concurrent.futures.Future):
+            if block is not None:
+                block.close()
+                block.unlink()
+            self._slots.release()
+            error = finished_future.exception()
+            if error is not None:
+                results_future.set_exception(error)
+                return
+            results = finished_future.result()
+            if isinstance(results, SharedPayload):
+                try:
+                    results = _take_payload(results, unlink=True)
+                except Exception as read_error:  # pylint: disable=broad-except
+                    _logger.error('Unable to read the results from shared memory: %s',
+                                  read_error)
+                    results_future.set_exception(read_error)
+                    return
+            results_future.set_result(results)
+
+        worker_future.add_done_callback(_cb_worker_finished)
+        return results_future
+
+    def _submit_to_pool(
+            self,
+            executor: typing.Callable[[bytes], bytes],
+            payload: typing.Union[bytes, SharedPayload]
+    ) -> concurrent.futures.Future:
+        """
+        Submit the execution to the pool and replace the pool if a worker process died
+
+        :param executor: The executor which shall handle the payload
+        :type executor: Callable[[bytes], bytes]
+        :param payload: The message body or a handle pointing to the message body
+        :type payload: bytes | SharedPayload
+        :return: The future of the execution in the worker process
+        :rtype: concurrent.futures.Future
+        """
+        pool = self._pool
+        try:
+            return pool.submit(_execute_in_worker, executor, payload, self._threshold)
+        except concurrent.futures.process.BrokenProcessPool:
+            self._restart_pool(pool)
+            return self._pool.submit(_execute_in_worker, executor, payload, self._threshold)
+
+    def _restart_pool(self, broken_pool: concurrent.futures.ProcessPoolExecutor):
+        """
+        Replace a pool which is unusable since one of its worker processes died
+
+        :param broken_pool: The pool which is broken
+        :type broken_pool: concurrent.futures.ProcessPoolExecutor
+        """
+        with self._pool_lock:
+            # Another thread may already have replaced the broken pool
+            if self._pool is not broken_pool:
+                return
+            _logger.error('A worker process terminated abruptly. Starting a new pool of worker '
+                          'processes')
+            broken_pool.shutdown(wait=False)
+            self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+
+    def shutdown(self, wait: bool = True):
+        """
+        Shut down the pool of worker processes
+
+        :param wait: Wait for the currently running executors to finish
+        :type wait: bool, optional
+        """
+        self._pool.shutdown(wait=wait)
@@ -0,0 +1,249 @@
+"""Recording of deliveries and their replay into a consumer without a message broker
+
+A record file starts with :data:`RECORD_FILE_MAGIC` followed by one entry per delivery. Every
+entry consists of a header packed as :data:`RECORD_HEADER`, containing the offset in seconds
+since the recording started and the lengths of the properties and the body, followed by the
+message properties and the message body. The message properties are stored in the encoding used
+by AMQP, so header values like bytes, timestamps and decimals are kept unchanged.
+"""
+import logging
+import struct
+import threading
+import time
+import typing
+
+import pika
+import pika.spec
+
+from . import metrics
+
+if typing.TYPE_CHECKING:  # pragma: no cover
+    from .basic_consumer import BasicConsumer
+
+_logger = logging.getLogger(__name__)
+
+RECORD_FILE_MAGIC = b'AMQPRPC\x02'
+"""The bytes every record file starts with"""
+
+RECORD_HEADER = struct.Struct('<dII')
+"""The header of every recorded delivery: offset, length of the properties, length of the body"""
+
+
+class RecordedDelivery(typing.NamedTuple):
+    """A delivery read from a record file"""
+
+    offset: float
+    """The time in seconds between the start of the recording and the delivery"""
+
+    properties: pika.spec.BasicProperties
+    """The properties of the message"""
+
+    body: bytes
+    """The content of the message"""
+
+
+class DeliveryRecorder:
+    """Write the deliveries received by a consumer into a record file"""
+
+    def __init__(self, record_file: str):
+        """
+        Initialize a new recorder
+
+        The record file is not touched until the recorder is opened with :meth:`open`
+
+        :param record_file: The path of the record file. An existing file will be overwritten
+            when the recorder is opened
+        :type record_file: str
+        """
+        self.record_file = record_file
+        self._file: typing.Optional[typing.BinaryIO] = None
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+
+    def open(self):
+        """Open the record file and start the recording. An existing file will be overwritten"""
+        with self._lock:
+            if self._file is not None and not self._file.closed:
+                return
+            self._file = open(self.record_file, 'wb')  # pylint: disable=consider-using-with
+            self._file.write(RECORD_FILE_MAGIC)
+            self._file.flush()
+            self._started_at = time.monotonic()
+
+    def record(self, message_properties: pika.spec.BasicProperties, message_body: bytes):
+        """
+        Append a delivery to the record file
+
+        The delivery is flushed to the record file immediately, so the record file is readable
+        while the recording is running. Deliveries are ignored if the recorder is not open.
+
+        :param message_properties: The properties of the message
+        :type message_properties: pika.spec.BasicProperties
+        :param message_body: The content of the message
+        :type message_body: bytes
+        """
+        offset = time.monotonic() - self._started_at
+        encoded_properties = b''.join(message_properties.encode())
+        with self._lock:
+            if self._file is None or self._file.closed:
+                return
+            self._file.write(RECORD_HEADER.pack(offset, len(encoded_properties),
+                                                len(message_body)))
+            self._file.write(encoded_properties)
+            self._file.write(message_body)
+            self._file.flush()
+
+    def close(self):
+        """Flush the recorded deliveries and close the record file"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+
+    def __enter__(self) -> 'DeliveryRecorder':
+        self.open()
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def read_recording(record_file: str) -> typing.Iterator[RecordedDelivery]:
+    """
+    Read the deliveries from a record file
+
+    :param record_file: The path of the record file
+    :type record_file: str
+    :return: The recorded deliveries in the order they were received
+    :rtype: Iterator[RecordedDelivery]
+    """
+    with open(record_file, 'rb') as file:
+        if file.read(len(RECORD_FILE_MAGIC)) != RECORD_FILE_MAGIC:
+            raise ValueError('The file {} is not a record file'.format(record_file))
+        while True:
+            header = file.read(RECORD_HEADER.size)
+            if not header:
+                return
+            if len(header) < RECORD_HEADER.size:
+                _logger.warning('The record file %s ends with an incomplete delivery',
+                                record_file)
+                return
+            offset, properties_length, body_length = RECORD_HEADER.unpack(header)
+            encoded_properties = file.read(properties_length)
+            body = file.read(body_length)
+            if len(encoded_properties) < properties_length or len(body) < body_length:
+                _logger.warning('The record file %s ends with an incomplete delivery',
+                                record_file)
+                return
+            properties = pika.spec.BasicProperties()
+            properties.decode(encoded_properties)
+            yield RecordedDelivery(offset, properties, body)
+
+
+class ReplayChannel:
+    """A stand-in for a channel which counts the interactions of a consumer during a replay"""
+
+    def __init__(self, statistics: typing.Optional[metrics.ServerStatistics] = None):
+        """
+        Initialize a new channel stand-in
+
+        :param statistics: The statistics of the consumer handling the replayed deliveries
+        :type statistics: metrics.ServerStatistics, optional
+        """
+        self.is_open = True
+        self.statistics = statistics
+        self.acknowledged = 0
+        self.rejected = 0
+        self.published = 0
+        self.published_bytes = 0
+        self._lock = threading.Lock()
+
+    def basic_ack(self, delivery_tag: int, *_args, **_kwargs):
+        """Count an acknowledged delivery"""
+        with self._lock:
+            self.acknowledged += 1
+
+    def basic_reject(self, delivery_tag: int, *_args, **_kwargs):
+        """Count a rejected delivery"""
+        with self._lock:
+            self.rejected += 1
+
+    def basic_publish(self, exchange: str, routing_key: str, body: bytes, *_args, **_kwargs):
+        """Count a published response and discard it"""
+        with self._lock:
+            self.published += 1
+            self.published_bytes += len(body)
+
+
+class _ReplayIOLoop:
+    """A stand-in for the ioloop of a connection which runs callbacks immediately"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def add_callback_threadsafe(self, callback: typing.Callable[[], typing.Any]):
+        """Run the callback in the calling thread while holding a lock"""
+        with self._lock:
+            callback()
+
+
+class _ReplayConnection:
+    """A stand-in for the connection of a consumer during a replay"""
+
+    def __init__(self):
+        self.ioloop = _ReplayIOLoop()
+
+
+def replay(
+        record_file: str,
+        consumer: 'BasicConsumer',
+        speed: typing.Optional[float] = 1.0,
+        timeout: float = 60.0
+) -> ReplayChannel:
+    """
+    Replay the deliveries from a record file straight into the message callback of a consumer
+
+    The consumer may not be connected to a message broker since the replay replaces its
+    connection with a stand-in. The consumer should have its own statistics, which are attached
+    to the returned channel stand-in.
+
+    :param record_file: The path of the record file
+    :type record_file: str
+    :param consumer: The consumer which shall handle the deliveries
+    :type consumer: BasicConsumer
+    :param speed: The factor by which the original rate of deliveries is scaled. If ``None``,
+        the deliveries are replayed as fast as possible, defaults to the original rate
+    :type speed: float, optional
+    :param timeout: The time in seconds to wait for executions still running in worker
+        processes after the last delivery was replayed, defaults to 60 seconds
+    :type timeout: float, optional
+    :return: The channel stand-in containing the counts of the interactions and the statistics
+        of the consumer
+    :rtype: ReplayChannel
+    """
+    if speed is not None and speed <= 0:
+        raise ValueError('The speed needs to be greater than zero')
+    channel = ReplayChannel(consumer.statistics)
+    consumer._connection = _ReplayConnection()  # pylint: disable=protected-access
+    started_at = time.monotonic()
+    first_offset = None
+    for delivery_tag, delivery in enumerate(read_recording(record_file), start=1):
+        if first_offset is None:
+            first_offset = delivery.offset
+        if speed is not None:
+            delay = started_at + (delivery.offset - first_offset) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        consumer._cb_new_message_received(  # pylint: disable=protected-access
+            channel,
+            pika.spec.Basic.Deliver(consumer_tag='replay', delivery_tag=delivery_tag),
+            delivery.properties,
+            delivery.body
+        )
+    # Wait for the executions which are still running in worker processes
+    deadline = time.monotonic() + timeout
+    while consumer.statistics.in_flight > 0:
+        if time.monotonic() > deadline:
+            _logger.warning('Not all executions finished before the timeout of the replay')
+            break
+        time.sleep(0.01)
+    return channel
@@ -0,0 +1,145 @@
+"""Sharded consumption of messages with a consistent hash exchange
+
+The messages are distributed over a fixed number of shard queues by a consistent hash exchange
+using the routing key (or a header) of the message. Therefore, all messages with the same key
+end up in the same shard. Every shard is consumed by exactly one replica of the server. The
+shards are assigned to the replicas using rendezvous hashing, so only the shards of a replica
+which joins or leaves are moved to another replica and the caches of all other replicas stay hot.
+
+The consistent hash exchange requires the ``rabbitmq_consistent_hash_exchange`` plugin to be
+enabled on the message broker.
+"""
+import hashlib
+import threading
+import typing
+
+CONSISTENT_HASH_EXCHANGE_TYPE = 'x-consistent-hash'
+"""The type of the exchange distributing the messages over the shards"""
+
+
+class ShardingConfiguration:
+    """The shards of a queue and the replicas which consume them"""
+
+    def __init__(
+            self,
+            shard_count: int,
+            replica_id: str,
+            replicas: typing.Iterable[str],
+            hash_header: typing.Optional[str] = None
+    ):
+        """
+        Initialize a new sharding configuration
+
+        :param shard_count: The number of shard queues the messages are distributed over. The
+            number needs to be the same for all replicas and should be noticeably higher than
+            the number of replicas to allow an even distribution
+        :type shard_count: int
+        :param replica_id: The identifier of this replica
+        :type replica_id: str
+        :param replicas: The identifiers of all replicas currently consuming the shards,
+            including this replica
+        :type replicas: Iterable[str]
+        :param hash_header: The name of a message header which is hashed instead of the routing
+            key to select the shard of a message
+        :type hash_header: str, optional
+        """
+        if shard_count < 1:
+            raise ValueError('The shard_count needs to be at least one')
+        if replica_id is None or len(replica_id.strip()) == 0:
+            raise ValueError('The replica_id is a required parameter and may not be empty')
+        self.shard_count = shard_count
+        self.replica_id = replica_id
+        self.hash_header = hash_header
+        self._lock = threading.Lock()
+        self._replicas = self._validate_replicas(replicas)
+
+    @property
+    def replicas(self) -> typing.FrozenSet[str]:
+        """The identifiers of all replicas currently consuming the shards"""
+        with self._lock:
+            return self._replicas
+
+    @property
+    def exchange_arguments(self) -> typing.Optional[typing.Dict[str, str]]:
+        """The arguments used for declaring the consistent hash exchange"""
+        if self.hash_header is None:
+            return None
+        return {'hash-header': self.hash_header}
+
+    @staticmethod
+    def shard_queue_name(queue_name: str, shard: int) -> str:
+        """
+        Build the name of a shard queue
+
+        :param queue_name: The name of the queue which is sharded
+        :type queue_name: str
+        :param shard: The number of the shard
+        :type shard: int
+        :return: The name of the shard queue
+        :rtype: str
+        """
+        return '{}.shard-{}'.format(queue_name, shard)
+
+    def shard_owner(self, shard: int) -> str:
+        """
+        Get the replica which consumes a shard
+
+        :param shard: The number of the shard
+        :type shard: int
+        :return: The identifier of the replica consuming the shard
+        :rtype: str
+        """
+        return max(self.replicas, key=lambda replica: self._weight(replica, shard))
+
+    def assigned_shards(self) -> typing.List[int]:
+        """
+        Get the shards which are consumed by this replica
+
+        :return: The numbers of the shards assigned to this replica
+        :rtype: list[int]
+        """
+        return [
+            shard for shard in range(self.shard_count)
+            if self.shard_owner(shard) == self.replica_id
+        ]
+
+    def rebalance(self, replicas: typing.Iterable[str]):
+        """
+        Update the replicas consuming the shards after a replica joined or left
+
+        :param replicas: The identifiers of all replicas currently consuming the shards,
+            including this replica
+        :type replicas: Iterable[str]
+        """
+        validated_replicas = self._validate_replicas(replicas)
+        with self._lock:
+            self._replicas = validated_replicas
+
+    def _validate_replicas(self, replicas: typing.Iterable[str]) -> typing.FrozenSet[str]:
+        """
+        Check that the replicas contain this replica
+
+        :param replicas: The identifiers of the replicas
+        :type replicas: Iterable[str]
+        :return: The identifiers of the replicas
+        :rtype: frozenset[str]
+        """
+        replicas = frozenset(replicas)
+        if self.replica_id not in replicas:
+            raise ValueError('The replicas need to contain the replica_id of this replica')
+        return replicas
+
+    @staticmethod
+    def _weight(replica: str, shard: int) -> int:
+        """
+        Calculate the rendezvous weight of a replica for a shard
+
+        :param replica: The identifier of the replica
+        :type replica: str
+        :param shard: The number of the shard
+        :type shard: int
+        :return: The weight of the replica. The replica with the highest weight owns the shard
+        :rtype: int
+        """
+        digest = hashlib.sha256('{}/{}'.format(replica, shard).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big')
@@ -0,0 +1,156 @@
+"""A validation pipeline which checks incoming messages before they are passed to the executor"""
+import collections
+import threading
+import typing
+
+import pika.spec
+
+REJECTED_SIZE = 'message_too_large'
+"""The message body exceeded the maximum size"""
+
+REJECTED_CONTENT_TYPE = 'unsupported_content_type'
+"""The content type of the message is not supported"""
+
+REJECTED_DECODING = 'undecodable_content'
+"""The message body could not be decoded"""
+
+REJECTED_SCHEMA = 'schema_mismatch'
+"""The decoded message content did not match the schema"""
+
+
+class ValidationResult(typing.NamedTuple):
+    """The result of a validation done by the :class:`ValidationPipeline`"""
+
+    valid: bool
+    """Indicates if the message is valid"""
+
+    reason: typing.Optional[str]
+    """The reason for the rejection of the message"""
+
+    content: typing.Any
+    """The decoded content of the message, or the message body if no decoder is set"""
+
+
+class ValidationPipeline:
+    """A pipeline which validates incoming messages and decodes them exactly once
+
+    The checks are run in the order of their costs: the size of the message body and the content
+    type of the message are checked before the message body is decoded and checked against the
+    schema. The decoded content is handed to the executor, so the executor does not need to
+    decode the message body again.
+    """
+
+    def __init__(
+            self,
+            max_size: typing.Optional[int] = None,
+            content_types: typing.Optional[typing.Iterable[str]] = None,
+            decoder: typing.Optional[typing.Callable[[bytes], typing.Any]] = None,
+            schema: typing.Optional[typing.Callable[[typing.Any], typing.Any]] = None
+    ):
+        """
+        Initialize a new validation pipeline
+
+        :param max_size: The maximum size of a message body in bytes. Larger messages will be
+            rejected without decoding them
+        :type max_size: int, optional
+        :param content_types: The content types which are accepted. Messages with another or
+            without a content type will be rejected. Only the media type is compared, so
+            parameters like ``charset`` and the case are ignored
+        :type content_types: Iterable[str], optional
+        :param decoder: A callable which decodes the message body, e.g. :func:`json.loads`. If the
+            decoder raises an error the message will be rejected. The decoded content will be
+            passed to the executor instead of the message body
+        :type decoder: Callable[[bytes], Any], optional
+        :param schema: A precompiled schema which is called with the decoded content. The
+            message will be rejected if the schema returns ``False`` or raises an error. This
+            allows using compiled validators like the ones created by ``fastjsonschema.compile``
+        :type schema: Callable[[Any], Any], optional
+        """
+        if max_size is not None and max_size < 0:
+            raise ValueError('The max_size may not be negative')
+        if decoder is not None and not callable(decoder):
+            raise TypeError('The decoder needs to be callable')
+        if schema is not None and not callable(schema):
+            raise TypeError('The schema needs to be callable')
+        self.max_size = max_size
+        self.content_types = None
+        if content_types is not None:
+            self.content_types = frozenset(
+                self._media_type(content_type) for content_type in content_types
+            )
+        self.decoder = decoder
+        self.schema = schema
+        self._rejections: typing.Counter[str] = collections.Counter()
+        self._accepted = 0
+        self._statistics_lock = threading.Lock()
+
+    def validate(
+            self,
+            message_body: bytes,
+            message_properties: typing.Optional[pika.spec.BasicProperties] = None
+    ) -> ValidationResult:
+        """
+        Validate a message and decode its content
+
+        :param message_body: The content of the message
+        :type message_body: bytes
+        :param message_properties: The properties of the message
+        :type message_properties: pika.spec.BasicProperties, optional
+        :return: The result of the validation
+        :rtype: ValidationResult
+        """
+        if self.max_size is not None and len(message_body) > self.max_size:
+            return self._reject(REJECTED_SIZE)
+        if self.content_types is not None:
+            content_type = None if message_properties is None else message_properties.content_type
+            if content_type is None or self._media_type(content_type) not in self.content_types:
+                return self._reject(REJECTED_CONTENT_TYPE)
+        content = message_body
+        if self.decoder is not None:
+            try:
+                content = self.decoder(message_body)
+            except Exception:  # pylint: disable=broad-except
+                return self._reject(REJECTED_DECODING)
+        if self.schema is not None:
+            try:
+                schema_valid = self.schema(content)
+            except Exception:  # pylint: disable=broad-except
+                schema_valid = False
+            if schema_valid is False:
+                return self._reject(REJECTED_SCHEMA)
+        with self._statistics_lock:
+            self._accepted += 1
+        return ValidationResult(True, None, content)
+
+    @property
+    def statistics(self) -> typing.Dict[str, int]:
+        """The number of accepted messages and the number of rejections for every reason"""
+        with self._statistics_lock:
+            statistics = dict(self._rejections)
+            statistics['accepted'] = self._accepted
+        return statistics
+
+    @staticmethod
+    def _media_type(content_type: str) -> str:
+        """
+        Strip the parameters from a content type
+
+        :param content_type: The content type, e.g. ``application/json; charset=utf-8``
+        :type content_type: str
+        :return: The lowercase media type, e.g. ``application/json``
+        :rtype: str
+        """
+        return content_type.split(';', 1)[0].strip().lower()
+
+    def _reject(self, reason: str) -> ValidationResult:
+        """
+        Count a rejection and build the result for it
+
+        :param reason: The reason for the rejection
+        :type reason: str
+        :return: The result of the validation
+        :rtype: ValidationResult
+        """
+        with self._statistics_lock:
+            self._rejections[reason] += 1
+        return ValidationResult(False, reason, None)